@@ -3,6 +3,8 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+from dash import no_update
 from dash_table import DataTable
 import dash_core_components as dcc
 import dash_html_components as html
@@ -10,6 +12,8 @@ from dash_extensions.enrich import Dash, Input, Output, Trigger, ServersideOutpu
 
 from data_utils import CallbackUtils
 from data_utils import LoadS3
+from data_utils import fetch_many
+from geo_utils import CountyIndex, county_api
 
 # Logging config
 logger = logging.getLogger(__name__)
@@ -33,6 +37,8 @@ logger.setLevel(logging.INFO)
 
 MB_TOKEN = os.getenv("MB_TOKEN")
 S3_FILE_NAME_NO_EXTENSION = os.getenv("S3_FILE_NAME_NO_EXTENSION")
+# Optional csv of ZIP code centroids (columns: zip, lat, lon) for "find my county"
+ZIP_CENTROIDS_KEY = os.getenv("ZIP_CENTROIDS_KEY")
 
 # Default to non-token theme if secret env variable is not available
 if MB_TOKEN:
@@ -42,11 +48,22 @@ else:
     MB_TOKEN = None
     MB_STYLE = "carto-darkmatter"
 
-# Get Maryland counties layer as geojson
+# Get Maryland counties layer as geojson and census data in parallel
 # source: frankrowe GH (see README)
-geojson_s3 = LoadS3("maryland-counties.geojson")
-geojson_counties = geojson_s3.read_s3_geojson()
-cb = CallbackUtils()
+startup_readers = {
+    "maryland-counties.geojson": LoadS3.read_s3_geojson,
+    "Population_Estimates_by_County.csv": LoadS3.read_s3_df,
+}
+if ZIP_CENTROIDS_KEY:
+    startup_readers[ZIP_CENTROIDS_KEY] = LoadS3.read_s3_df
+startup_data = fetch_many(startup_readers)
+geojson_counties = startup_data["maryland-counties.geojson"]
+cb = CallbackUtils(census_data=startup_data["Population_Estimates_by_County.csv"])
+
+# Spatial index for point-to-county lookups
+county_index = CountyIndex(geojson_counties)
+if ZIP_CENTROIDS_KEY:
+    county_index.load_zip_centroids(startup_data[ZIP_CENTROIDS_KEY])
 
 # Import CSS-referenced font
 external_stylesheets = [
@@ -61,11 +78,41 @@ app = Dash(__name__, external_stylesheets=external_stylesheets)
 # The server variable will be referenced late by the Gunicorn WSGI
 server = app.server
 
+
+# Point-to-county lookups as JSON at /api/county
+server.register_blueprint(county_api(county_index))
+
+
 # This makes it easier to change PORT without having to reupload a new revision of the app
 PORT = int(os.getenv("PORT"))
 
 app.title = "#MDVaccineWatch"
 
+# Dropdown value for comparing every county
+COMPARE_ALL = "ALL"
+
+# Shared by the county and comparison tables
+TABLE_STYLE = dict(
+    style_table={"overflowX": "auto"},
+    style_cell={
+        "backgroundColor": "black",
+        "color": "#ffffff",
+        "textAlign": "center",
+        "fontFamily": "'Open sans', sans-serif",
+        "whiteSpace": "normal",
+        "height": "auto",
+    },
+    style_header={"color": "#f1ba20", "font-weight": "bold"},
+    style_data_conditional=[
+        {  # override hot pink selected color
+            "if": {"state": "active"},
+            "backgroundColor": "black",
+            "border": "3px solid white",
+            "color": "white",
+        }
+    ],
+)
+
 def serve_layout():
     return html.Div(
         [
@@ -107,6 +154,19 @@ def serve_layout():
                     ),
                     # State stats
                     dcc.Markdown(id="state-stats"),
+                    html.Div(  # Find county by coordinates or ZIP code
+                        [
+                            html.P("Find your county (lat, lon or ZIP code):"),
+                            dcc.Input(
+                                id="find-county",
+                                type="text",
+                                debounce=True,
+                                placeholder="39.2904, -76.6122",
+                            ),
+                            html.Span(id="find-county-message"),
+                        ],
+                        className="find-county-container",
+                    ),
                     # Display date selected
                     dcc.Markdown(id="output-date-location"),
                     html.Div(
@@ -115,24 +175,7 @@ def serve_layout():
                             columns=[],
                             data=[],
                             column_selectable=False,
-                            style_table={"overflowX": "auto"},
-                            style_cell={
-                                "backgroundColor": "black",
-                                "color": "#ffffff",
-                                "textAlign": "center",
-                                "fontFamily": "'Open sans', sans-serif",
-                                "whiteSpace": "normal",
-                                "height": "auto",
-                            },
-                            style_header={"color": "#f1ba20", "font-weight": "bold"},
-                            style_data_conditional=[
-                                {  # override hot pink selected color
-                                    "if": {"state": "active"},
-                                    "backgroundColor": "black",
-                                    "border": "3px solid white",
-                                    "color": "white",
-                                }
-                            ],
+                            **TABLE_STYLE,
                         ),
                         className="table-container",
                     ),
@@ -211,6 +254,39 @@ def serve_layout():
                         config={"scrollZoom": False},
                         className="coropleth-container",
                     ),
+                    html.Div(  # Multi-county comparison
+                        [
+                            html.P("Compare counties:"),
+                            dcc.Dropdown(
+                                id="compare-counties",
+                                options=[
+                                    {"label": "All counties", "value": COMPARE_ALL}
+                                ]
+                                + [
+                                    {"label": county, "value": county}
+                                    for county in cb.get_counties()
+                                ],
+                                multi=True,
+                                placeholder="Select counties to compare",
+                            ),
+                            html.Div(
+                                DataTable(
+                                    id="compare-table",
+                                    columns=[],
+                                    data=[],
+                                    sort_action="native",
+                                    column_selectable=False,
+                                    **TABLE_STYLE,
+                                ),
+                                className="table-container",
+                            ),
+                            dcc.Graph(
+                                id="compare-timeseries",
+                                config={"scrollZoom": False},
+                            ),
+                        ],
+                        className="compare-container",
+                    ),
                     html.Div(
                         [
                             html.A("Sources:"),
@@ -295,10 +371,6 @@ def display_choropleth(
     logging.debug(selected_dose, type(selected_dose))
     logging.debug(selected_button, type(selected_button))
 
-    slider_date = cb.get_slider_date(df, selected_date)
-
-    dff1 = cb.filter_by_date(df, slider_date)
-
     p = False
     tick_format = ","
     if selected_button == "Relative":
@@ -306,7 +378,8 @@ def display_choropleth(
         p = True
         tick_format = "%"
 
-    dff1 = cb.get_county_stats(dff=dff1, percent=p)
+    # Date slice and normalization are shared with display_stats through cb.cache
+    dff1 = cb.cached_county_stats(df, selected_date, percent=p)
 
     # Get max of aggregates returned by get_county_stats
     mx = max(dff1[selected_dose])
@@ -347,6 +420,22 @@ def display_choropleth(
     return fig
 
 
+@app.callback(
+    [
+        Output("choropleth", "clickData"),
+        Output("find-county-message", "children"),
+    ],
+    Input("find-county", "value"),
+    prevent_initial_call=True,
+)
+def find_county(query):
+    """Select the county matching the entered coordinates or ZIP, as if clicked"""
+    county = county_index.find(query)
+    if county is None:
+        return no_update, " No Maryland county found"
+    return {"points": [{"location": county}]}, ""
+
+
 @app.callback(
     [
         Output("state-stats", "children"),
@@ -367,9 +456,8 @@ def display_stats(selected_date_index, clickData, selected_button, df):
     logging.debug(clickData)
     logging.debug(type(clickData))
 
-    slider_date = cb.get_slider_date(df, selected_date_index)
+    slider_date = cb.cached_slider_date(df, selected_date_index)
     dt_slider_date = pd.to_datetime(str(slider_date))
-    dff2 = cb.filter_by_date(df, slider_date)
 
     output_date_location = f"Date selected: **{dt_slider_date.strftime('%B %-d, %Y')}**"
 
@@ -378,7 +466,9 @@ def display_stats(selected_date_index, clickData, selected_button, df):
         p = True
 
     # Get total state sums before filtering by County
-    atleast1_sum_s, fully_sum_s = cb.get_state_stats(dff=dff2, percent=p)
+    atleast1_sum_s, fully_sum_s = cb.cached_state_stats(
+        df, selected_date_index, percent=p
+    )
 
     pop_est_state = cb.get_county_pop("State")
 
@@ -411,7 +501,8 @@ def display_stats(selected_date_index, clickData, selected_button, df):
     pop_est = cb.get_county_pop(county_click)
     output_date_location += f"  |  County Estimated Population: **{pop_est:{','}}**"
 
-    dff2 = cb.get_county_stats(dff=dff2, percent=p)
+    dff2 = cb.cached_county_stats(df, selected_date_index, percent=p)
+    logging.debug(cb.cache.info())
 
     # Filter by county
     stats_df = cb.filter_by_county(dff2, county_click)
@@ -431,5 +522,74 @@ def display_stats(selected_date_index, clickData, selected_button, df):
     return state_stats, output_date_location, table_cols, table_data
 
 
+@app.callback(
+    [
+        Output("compare-table", "columns"),
+        Output("compare-table", "data"),
+        Output("compare-timeseries", "figure"),
+    ],
+    [
+        Input("selected-date-index", "value"),
+        Input("compare-counties", "value"),
+        Input("selected-dose", "value"),
+        Input("select-absolute-relative", "value"),
+        Input("store", "data"),
+    ],
+)
+def display_comparison(
+    selected_date_index, selected_counties, selected_dose, selected_button, df
+):
+    """Side-by-side stats and history of the selected counties"""
+    if not selected_counties:
+        placeholder = "Select counties above to compare them side by side"
+        empty_fig = go.Figure(layout={"template": "plotly_dark"})
+        return [{"id": "placeholder", "name": placeholder}], [], empty_fig
+
+    if COMPARE_ALL in selected_counties:
+        counties = cb.get_counties()
+    else:
+        counties = selected_counties
+
+    p = False
+    if selected_button == "Relative":
+        p = True
+
+    compare_df = cb.get_comparison(
+        df, counties, selected_date_index, selected_dose, percent=p
+    )
+
+    table_cols = [{"id": "County", "name": "County"}]
+    table_cols += [
+        {
+            "id": col,
+            "name": col,
+            "type": "numeric",
+            "format": cb.format_table(percent=p and col != "Population"),
+        }
+        for col in compare_df.columns
+        if col not in ("County", "Rank", "Percentile")
+    ]
+    table_cols += [
+        {"id": "Rank", "name": f"Rank ({selected_dose})", "type": "numeric"},
+        {
+            "id": "Percentile",
+            "name": f"Percentile ({selected_dose})",
+            "type": "numeric",
+            "format": cb.format_table(percent=True),
+        },
+    ]
+
+    history = cb.get_comparison_timeseries(df, counties, selected_dose, percent=p)
+    fig = px.line(
+        history, x="date", y=selected_dose, color="County", template="plotly_dark"
+    )
+    fig.update_layout(
+        margin={"r": 0, "t": 30, "l": 0, "b": 0},
+        yaxis_tickformat="%" if p else ",",
+    )
+
+    return table_cols, compare_df.to_dict("records"), fig
+
+
 if __name__ == "__main__":
     app.run_server(host="0.0.0.0", port=PORT)
@@ -1,10 +1,16 @@
 import os
 import io
-from typing import Tuple
+import gzip
 import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import boto3.session
+from botocore.config import Config
 import pandas as pd
 from dash_table import FormatTemplate
 from dash_table.Format import Format
@@ -15,27 +21,129 @@ AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
 AWS_DEFAULT_REGION = os.getenv("AWS_DEFAULT_REGION")
 ACCESS_ID = os.getenv("AWS_ACCESS_KEY_ID")
 ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+# Point at a local S3 stand-in (e.g. MinIO) instead of AWS when set
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 10))
+S3_FETCH_WORKERS = int(os.getenv("S3_FETCH_WORKERS", 4))
+CALLBACK_CACHE_SIZE = int(os.getenv("CALLBACK_CACHE_SIZE", 256))
 
 DATABASE_URI = os.getenv("DATABASE_URI")
 
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the S3 client shared by every LoadS3 in this process
+    boto3 clients are thread-safe, but must not be shared across forked workers
+    """
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            session = boto3.session.Session(
+                aws_access_key_id=ACCESS_ID,
+                aws_secret_access_key=ACCESS_KEY,
+                region_name=AWS_DEFAULT_REGION,
+            )
+            _s3_client = session.client(
+                "s3",
+                endpoint_url=AWS_S3_ENDPOINT_URL,
+                config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+            )
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+def fetch_many(readers: Dict[str, Callable[["LoadS3"], Any]]) -> Dict[str, Any]:
+    """
+    Fetch several keys concurrently, e.g. {key: LoadS3.read_s3_df}
+    Each reader downloads and parses its body in a worker thread, so both the
+    requests and the body transfers overlap
+    """
+    workers = max(1, min(S3_FETCH_WORKERS, len(readers)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(reader, LoadS3(key)) for key, reader in readers.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+
+def apply_delta(base: List[str], delta: dict) -> List[str]:
+    """Rebuild the rows of a snapshot version from the previous version's rows"""
+    removed = set()
+    for start, end in delta["removed"]:
+        removed.update(range(start, end))
+    kept = (line for i, line in enumerate(base) if i not in removed)
+
+    rows = []
+    for pos, line in delta["added"]:
+        while len(rows) < pos:
+            rows.append(next(kept))
+        rows.append(line)
+    rows.extend(kept)
+    return rows
+
 
 class LoadS3:
     def __init__(self, key: str):
         self.key = key
-        session = boto3.session.Session(
-            aws_access_key_id=ACCESS_ID, aws_secret_access_key=ACCESS_KEY
-        )
-        self.s3_resource = session.resource("s3")
-        self.obj = self.s3_resource.meta.client.get_object(
-            Bucket=AWS_S3_BUCKET, Key=self.key
-        )
+        self.s3_client = get_s3_client()
+        self._obj = None
+
+    @property
+    def obj(self) -> dict:
+        """get_object response, requested on first access"""
+        if self._obj is None:
+            self._obj = self.s3_client.get_object(Bucket=AWS_S3_BUCKET, Key=self.key)
+        return self._obj
 
     def read_s3_geojson(self):
-        return json.load(io.BytesIO(self.obj["Body"].read()))
+        return json.load(self.obj["Body"])
 
     def read_s3_df(self) -> pd.DataFrame:
-        """Read data from S3 to Pandas DataFrame"""
-        return pd.read_csv(io.BytesIO(self.obj["Body"].read()))
+        """Read data from S3 to Pandas DataFrame, parsing the body as it streams"""
+        return pd.read_csv(self.obj["Body"])
+
+    def read_s3_gzip(self) -> bytes:
+        return gzip.decompress(self.obj["Body"].read())
+
+    def read_snapshot(self, version: int = None) -> pd.DataFrame:
+        """
+        Rebuild a dataset version from the snapshot manifest at this key
+        (e.g. "<name>_clean_snapshots/manifest.json"), defaulting to the latest
+        Only the nearest checkpoint and the deltas after it are fetched
+        """
+        versions = json.load(self.obj["Body"])["versions"]
+        if version is None:
+            version = len(versions) - 1
+        if not 0 <= version < len(versions):
+            raise ValueError(
+                f"{self.key} has versions 0..{len(versions) - 1}, not {version}"
+            )
+        start = version
+        while versions[start]["type"] != "checkpoint":
+            start -= 1
+
+        chain = versions[start : version + 1]
+        bodies = fetch_many({entry["key"]: LoadS3.read_s3_gzip for entry in chain})
+        bodies = [bodies[entry["key"]] for entry in chain]
+
+        lines = bodies[0].decode("utf-8").splitlines()
+        header, rows = lines[0], lines[1:]
+        for body in bodies[1:]:
+            delta = json.loads(body)
+            header, rows = delta["header"], apply_delta(rows, delta)
+
+        text = "\n".join([header] + rows) + "\n"
+        # The manifest records the hash of the published csv
+        content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if content_hash != versions[version]["hash"]:
+            raise ValueError(
+                f"{self.key} version {version} does not match its recorded hash"
+            )
+        return pd.read_csv(io.StringIO(text))
 
     def prep_df(self, df: pd.DataFrame) -> pd.DataFrame:
         """Transform Pandas DataFrame after csv read"""
@@ -64,7 +172,10 @@ class LoadS3:
 
     def etl_pipeline(self) -> pd.DataFrame:
         df = self.read_s3_df()
-        return self.prep_df(df)
+        df = self.prep_df(df)
+        # Identifies the dataset for CallbackUtils memoization, survives pickling
+        df.attrs["version"] = self.obj.get("ETag")
+        return df
 
 
 class LoadDb:
@@ -78,10 +189,55 @@ class LoadDb:
         return df
 
 
+class MemoCache:
+    """Thread-safe LRU cache of intermediate callback results with hit/miss counters"""
+
+    def __init__(self, maxsize: int = CALLBACK_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+
+        # Computed outside the lock, concurrent misses on one key just race
+        value = compute()
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+
 class CallbackUtils:
-    def __init__(self):
-        census_s3 = LoadS3("Population_Estimates_by_County.csv")
-        self.census_data = census_s3.read_s3_df()
+    def __init__(
+        self,
+        census_data: pd.DataFrame = None,
+        cache_size: int = CALLBACK_CACHE_SIZE,
+    ):
+        if census_data is None:
+            census_data = LoadS3("Population_Estimates_by_County.csv").read_s3_df()
+        self.census_data = census_data
+        # Population indexed by county name for vectorized lookups
+        self.census_pop = self.census_data.set_index("County")["Population"]
+        self.cache = MemoCache(maxsize=cache_size)
         self.features = [
             "County",
             "First Dose",
@@ -101,12 +257,12 @@ class CallbackUtils:
         return df["date"].unique()[selected_date_index]
 
     def get_county_pop(self, county_name: str) -> int:
-        """Match df.County on county name input str"""
-        return int(
-            self.census_data.loc[
-                self.census_data["County"] == county_name, "Population"
-            ].values
-        )
+        """Look up the estimated population of a county name input str"""
+        return int(self.census_pop[county_name])
+
+    def get_counties(self) -> List[str]:
+        """All county names in the census data (excluding the State total)"""
+        return [c for c in self.census_pop.index if c != "State"]
 
     def filter_by_date(
         self, df: pd.DataFrame, slider_date: np.datetime64
@@ -130,8 +286,8 @@ class CallbackUtils:
         "First Dose", "Second Dose", & "Single Dose"
         Normalize data values if param percent == True
         """
-        # Get rid of index
-        dff.reset_index(drop=True, inplace=True)
+        # Get rid of index (without mutating the input, it may be cached)
+        dff = dff.reset_index(drop=True)
 
         if percent == True:
             # Copy estimated pop by county
@@ -175,3 +331,118 @@ class CallbackUtils:
             return Format().group(True)
         else:
             return FormatTemplate.percentage(2)
+
+    # Memoized intermediates shared by the callbacks
+    # Keys are the real inputs plus the dataset version, so any callback
+    # computing the same slice reuses it
+
+    def dataset_version(self, df: pd.DataFrame) -> Hashable:
+        """Version set by LoadS3.etl_pipeline, or a content hash as a fallback"""
+        version = df.attrs.get("version")
+        if version is None:
+            version = int(pd.util.hash_pandas_object(df).sum())
+            df.attrs["version"] = version
+        return version
+
+    def cached_slider_date(
+        self, df: pd.DataFrame, selected_date_index: int
+    ) -> np.datetime64:
+        key = ("slider_date", self.dataset_version(df), selected_date_index)
+        return self.cache.get_or_compute(
+            key, lambda: self.get_slider_date(df, selected_date_index)
+        )
+
+    def cached_date_slice(
+        self, df: pd.DataFrame, selected_date_index: int
+    ) -> pd.DataFrame:
+        """filter_by_date for the slider index, callers must not modify the result"""
+        key = ("date_slice", self.dataset_version(df), selected_date_index)
+        return self.cache.get_or_compute(
+            key,
+            lambda: self.filter_by_date(
+                df, self.cached_slider_date(df, selected_date_index)
+            ),
+        )
+
+    def cached_county_stats(
+        self, df: pd.DataFrame, selected_date_index: int, percent: bool = False
+    ) -> pd.DataFrame:
+        """get_county_stats of the date slice, callers must not modify the result"""
+        key = ("county_stats", self.dataset_version(df), selected_date_index, percent)
+        return self.cache.get_or_compute(
+            key,
+            lambda: self.get_county_stats(
+                dff=self.cached_date_slice(df, selected_date_index), percent=percent
+            ),
+        )
+
+    def cached_state_stats(
+        self, df: pd.DataFrame, selected_date_index: int, percent: bool = False
+    ) -> Tuple[np.int64, np.int64]:
+        key = ("state_stats", self.dataset_version(df), selected_date_index, percent)
+        return self.cache.get_or_compute(
+            key,
+            lambda: self.get_state_stats(
+                dff=self.cached_date_slice(df, selected_date_index), percent=percent
+            ),
+        )
+
+    # Multi-county comparison
+
+    def prepare_panel(self, df: pd.DataFrame, percent: bool = False) -> pd.DataFrame:
+        """
+        Wide table of every county's stats: one row per date,
+        columns (feature, County), normalized by population if percent == True
+        """
+        county_stats_features = [col for col in self.features if col != "County"]
+        panel = df.pivot_table(
+            index="date", columns="County", values=county_stats_features, aggfunc="last"
+        )
+        if percent:
+            counties = panel.columns.get_level_values("County")
+            panel = panel / self.census_pop.reindex(counties).values
+        return panel
+
+    def cached_panel(self, df: pd.DataFrame, percent: bool = False) -> pd.DataFrame:
+        """prepare_panel shared by every comparison, callers must not modify it"""
+        key = ("panel", self.dataset_version(df), percent)
+        return self.cache.get_or_compute(
+            key, lambda: self.prepare_panel(df, percent=percent)
+        )
+
+    def get_comparison(
+        self,
+        df: pd.DataFrame,
+        counties: List[str],
+        selected_date_index: int,
+        selected_feature: str,
+        percent: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Stats of the selected counties on the slider date, gathered in one
+        lookup on the panel, ranked (1 = highest) and with percentile across
+        the selection for the selected feature
+        """
+        panel = self.cached_panel(df, percent=percent)
+        slider_date = self.cached_slider_date(df, selected_date_index)
+
+        table = panel.loc[slider_date].unstack(level=0).reindex(counties)
+        table = table[[col for col in self.features if col != "County"]]
+        table.insert(0, "Population", self.census_pop.reindex(counties).values)
+        table["Rank"] = table[selected_feature].rank(ascending=False, method="min")
+        table["Percentile"] = table[selected_feature].rank(pct=True)
+        return table.rename_axis("County").reset_index()
+
+    def get_comparison_timeseries(
+        self,
+        df: pd.DataFrame,
+        counties: List[str],
+        selected_feature: str,
+        percent: bool = False,
+    ) -> pd.DataFrame:
+        """Long-form history of one feature for the selected counties"""
+        panel = self.cached_panel(df, percent=percent)
+        history = panel[selected_feature].reindex(columns=counties)
+        return history.reset_index().melt(
+            id_vars="date", var_name="County", value_name=selected_feature
+        )
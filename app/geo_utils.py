@@ -0,0 +1,172 @@
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from flask import Blueprint, jsonify, request
+
+Bounds = Tuple[float, float, float, float]  # minx, miny, maxx, maxy
+
+
+class STRtree:
+    """
+    Read-only R-tree of bounding boxes, bulk loaded with Sort-Tile-Recursive packing
+    Leaves hold the index of the box they were built from
+    """
+
+    def __init__(self, boxes: List[Bounds], node_capacity: int = 4):
+        self.node_capacity = node_capacity
+        nodes = [(box, i) for i, box in enumerate(boxes)]
+        while len(nodes) > 1:
+            nodes = self._pack(nodes)
+        self.root = nodes[0] if nodes else None
+
+    def _pack(self, nodes: list) -> list:
+        """Group one level of nodes into parents of at most node_capacity children"""
+        cap = self.node_capacity
+        n_parents = math.ceil(len(nodes) / cap)
+        slice_size = math.ceil(math.sqrt(n_parents)) * cap
+
+        def center(node, axis):
+            box = node[0]
+            return box[axis] + box[axis + 2]
+
+        nodes = sorted(nodes, key=lambda node: center(node, 0))
+        parents = []
+        for i in range(0, len(nodes), slice_size):
+            vertical = sorted(nodes[i : i + slice_size], key=lambda n: center(n, 1))
+            for j in range(0, len(vertical), cap):
+                children = vertical[j : j + cap]
+                bounds = (
+                    min(c[0][0] for c in children),
+                    min(c[0][1] for c in children),
+                    max(c[0][2] for c in children),
+                    max(c[0][3] for c in children),
+                )
+                parents.append((bounds, children))
+        return parents
+
+    def query(self, x: float, y: float) -> List[int]:
+        """Indices of all boxes containing the point"""
+        hits = []
+        stack = [self.root] if self.root else []
+        while stack:
+            (minx, miny, maxx, maxy), payload = stack.pop()
+            if not (minx <= x <= maxx and miny <= y <= maxy):
+                continue
+            if isinstance(payload, list):
+                stack.extend(payload)
+            else:
+                hits.append(payload)
+        return hits
+
+
+def ring_edges(ring: list) -> Tuple[np.ndarray, ...]:
+    """Edge start and end coordinates of a ring: xs, ys, xs_next, ys_next"""
+    coords = np.asarray(ring, dtype=float)
+    xs, ys = coords[:, 0], coords[:, 1]
+    return xs, ys, np.roll(xs, -1), np.roll(ys, -1)
+
+
+def point_in_ring(x: float, y: float, edges: Tuple[np.ndarray, ...]) -> bool:
+    """Even-odd ray casting test against the edges of a closed ring"""
+    xs, ys, xs_next, ys_next = edges
+    crosses = (ys > y) != (ys_next > y)
+    if not crosses.any():
+        return False
+    xs, ys = xs[crosses], ys[crosses]
+    xs_next, ys_next = xs_next[crosses], ys_next[crosses]
+    x_intersect = xs + (y - ys) * (xs_next - xs) / (ys_next - ys)
+    return bool(np.count_nonzero(x < x_intersect) % 2)
+
+
+class CountyIndex:
+    """Point-to-county lookups over the counties GeoJSON"""
+
+    def __init__(self, geojson: dict, name_key: str = "name"):
+        # One entry per polygon part: (county name, [exterior, *holes] edges)
+        self.parts = []
+        boxes = []
+        for feature in geojson["features"]:
+            name = feature["properties"][name_key]
+            geometry = feature["geometry"]
+            if geometry["type"] == "Polygon":
+                polygons = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiPolygon":
+                polygons = geometry["coordinates"]
+            else:
+                continue
+
+            for polygon in polygons:
+                rings = [ring_edges(ring) for ring in polygon]
+                xs, ys = rings[0][0], rings[0][1]
+                self.parts.append((name, rings))
+                boxes.append((xs.min(), ys.min(), xs.max(), ys.max()))
+
+        self.tree = STRtree(boxes)
+        self.zip_counties = {}
+
+    def lookup(self, lat: float, lon: float) -> Optional[str]:
+        """Return the name of the county containing the point, if any"""
+        for i in self.tree.query(lon, lat):
+            name, rings = self.parts[i]
+            exterior, holes = rings[0], rings[1:]
+            if point_in_ring(lon, lat, exterior) and not any(
+                point_in_ring(lon, lat, hole) for hole in holes
+            ):
+                return name
+        return None
+
+    def load_zip_centroids(self, df: pd.DataFrame) -> None:
+        """Resolve a table of ZIP centroids (columns: zip, lat, lon) to counties"""
+        # Any blank row makes read_csv parse the zip column as float ("20601.0"),
+        # so codes are formatted from their integer value
+        df = df.assign(zip=pd.to_numeric(df["zip"], errors="coerce"))
+        df = df.dropna(subset=["zip", "lat", "lon"])
+
+        zip_counties = {}
+        for zip_code, lat, lon in zip(df["zip"].astype(int), df["lat"], df["lon"]):
+            county = self.lookup(lat, lon)
+            if county:
+                zip_counties[f"{zip_code:05d}"] = county
+        self.zip_counties = zip_counties
+
+    def lookup_zip(self, zip_code: str) -> Optional[str]:
+        return self.zip_counties.get(str(zip_code).strip().zfill(5))
+
+    def find(self, query: str) -> Optional[str]:
+        """Resolve user input, either "lat, lon" or a 5 digit ZIP code, to a county"""
+        query = (query or "").strip()
+        if "," in query:
+            try:
+                lat, lon = (float(v) for v in query.split(","))
+            except ValueError:
+                return None
+            return self.lookup(lat, lon)
+        if query.isdigit():
+            return self.lookup_zip(query)
+        return None
+
+
+def county_api(county_index: CountyIndex) -> Blueprint:
+    """Flask blueprint serving /api/county from the given index"""
+    api = Blueprint("county_api", __name__)
+
+    @api.route("/api/county")
+    def county_lookup():
+        """Return the county containing ?lat=&lon= (or ?zip=) as JSON"""
+        if "zip" in request.args:
+            county = county_index.lookup_zip(request.args["zip"])
+        else:
+            try:
+                lat = float(request.args["lat"])
+                lon = float(request.args["lon"])
+            except (KeyError, ValueError):
+                return jsonify(error="lat and lon (or zip) are required"), 400
+            county = county_index.lookup(lat, lon)
+
+        if county is None:
+            return jsonify(county=None), 404
+        return jsonify(county=county)
+
+    return api
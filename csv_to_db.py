@@ -1,50 +1,251 @@
 import os
-from scheduler.helpers import WriteData
-from sys import argv
-from sqlalchemy import create_engine
+import io
+import csv
+import time
+import hashlib
+import argparse
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
 import pandas as pd
+from sqlalchemy import (
+    create_engine,
+    MetaData,
+    Table,
+    Column,
+    String,
+    Integer,
+    inspect,
+    select,
+)
+from scheduler.helpers import WriteData
 
 DATABASE_URI = os.getenv("DATABASE_URI")
+DEFAULT_TABLE = "vaccines"
+DEFAULT_CHUNKSIZE = 50_000
+
+# Finished chunks are recorded in the same transaction as their rows,
+# so an interrupted backfill can resume without loading a chunk twice
+metadata = MetaData()
+checkpoints = Table(
+    "backfill_checkpoints",
+    metadata,
+    Column("source", String, primary_key=True),
+    Column("chunk", Integer, primary_key=True),
+    Column("rows", Integer, nullable=False),
+)
+
+_engines = {}  # one engine per worker process
+
+
+def get_engine(database_uri: str):
+    if database_uri not in _engines:
+        _engines[database_uri] = create_engine(database_uri)
+    return _engines[database_uri]
+
+
+def quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def psql_insert_copy(table, conn, keys, data_iter):
+    """pandas.to_sql insert method using Postgres COPY instead of INSERT statements"""
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(data_iter)
+        buffer.seek(0)
+
+        # Quoted like to_sql quotes them when creating the table, so mixed case
+        # and reserved names resolve to the same table
+        columns = ", ".join(quote_identifier(k) for k in keys)
+        table_name = quote_identifier(table.name)
+        if table.schema:
+            table_name = f"{quote_identifier(table.schema)}.{table_name}"
+
+        cur.copy_expert(
+            f"COPY {table_name} ({columns}) FROM STDIN WITH CSV", buffer
+        )
+
+
+def file_digest(path: str) -> str:
+    """sha256 of a file, read in blocks"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def integer_columns(engine, table_name: str) -> List[str]:
+    """Names of the integer typed columns of an existing table"""
+    return [
+        col["name"]
+        for col in inspect(engine).get_columns(table_name)
+        if isinstance(col["type"], Integer)
+    ]
+
+
+def match_column_types(df: pd.DataFrame, int_columns: List[str]) -> pd.DataFrame:
+    """
+    Cast float columns back to int where the table column is an integer
+    clean_df's fillna(0) turns an int column with gaps into floats, which COPY
+    would send as "123.0" and Postgres rejects for an integer column
+    """
+    for col in int_columns:
+        if col not in df.columns or df[col].dtype.kind != "f":
+            continue
+        if not (df[col] % 1 == 0).all():
+            raise ValueError(f"Column {col} has fractional values, table is integer")
+        df[col] = df[col].astype("int64")
+    return df
+
+
+def prep_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """Clean a raw csv chunk the same way the scheduler cleans its uploads"""
+    df = WriteData().clean_df(df)  # returns Pandas df
+
+    # datetime data cannot be localized, must be timezone unaware
+    df["vaccination_date"] = pd.to_datetime(df["vaccination_date"])
+    df["vaccination_date"] = df["vaccination_date"].dt.tz_localize(None)
+    return df
+
+
+def load_chunk(
+    database_uri: str,
+    table_name: str,
+    int_columns: List[str],
+    source: str,
+    chunk: int,
+    df: pd.DataFrame,
+) -> int:
+    """Clean and insert a single chunk and its checkpoint in one transaction"""
+    engine = get_engine(database_uri)
+    df = match_column_types(prep_chunk(df), int_columns)
+
+    # COPY on postgres, executemany elsewhere (e.g. a local sqlite test database)
+    method = psql_insert_copy if engine.dialect.name == "postgresql" else None
+
+    with engine.begin() as conn:
+        df.to_sql(table_name, conn, if_exists="append", method=method)
+        conn.execute(
+            checkpoints.insert().values(source=source, chunk=chunk, rows=len(df))
+        )
+    return len(df)
+
+
+def get_finished_chunks(engine, source: str) -> set:
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select([checkpoints.c.chunk]).where(checkpoints.c.source == source)
+        )
+        return {row[0] for row in rows}
+
+
+def backfill(
+    csv_file: str,
+    database_uri: str,
+    table_name: str = DEFAULT_TABLE,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    workers: int = os.cpu_count(),
+) -> int:
+    """
+    Load a historical csv into the database in chunks across worker processes
+    Chunks finished by a previous (interrupted) run are skipped
+    Returns the number of rows loaded by this run
+    """
+    engine = get_engine(database_uri)
+    metadata.create_all(engine)
+
+    # Chunk numbers only identify the same rows for the same file and chunksize
+    digest = file_digest(csv_file)
+    source = f"{os.path.basename(csv_file)}:{digest}:{chunksize}"
+    finished = get_finished_chunks(engine, source)
+    if finished:
+        print(f"Resuming: {len(finished)} chunks already loaded")
+
+    # Create the table from the first chunk so workers only ever append
+    first = prep_chunk(pd.read_csv(csv_file, nrows=chunksize))
+    first.head(0).to_sql(table_name, engine, if_exists="append")
+    int_columns = integer_columns(engine, table_name)
+    # Forked workers must not share the parent's pooled connections
+    engine.dispose()
+
+    rows_loaded = 0
+    start = time.perf_counter()
+    pending = set()
+
+    def collect(done):
+        nonlocal rows_loaded
+        for future in done:
+            rows_loaded += future.result()
+        elapsed = time.perf_counter() - start
+        print(f"{rows_loaded} rows loaded ({rows_loaded / elapsed:,.0f} rows/sec)")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        reader = pd.read_csv(csv_file, chunksize=chunksize)
+        for chunk, df in enumerate(reader):
+            if chunk in finished:
+                continue
+
+            # Bound the number of chunks held in memory at once
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(
+                executor.submit(
+                    load_chunk,
+                    database_uri,
+                    table_name,
+                    int_columns,
+                    source,
+                    chunk,
+                    df,
+                )
+            )
+
+        if pending:
+            collect(wait(pending).done)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"BACKFILL COMPLETE: {rows_loaded} rows in {elapsed:.1f}s "
+        f"({rows_loaded / max(elapsed, 1e-9):,.0f} rows/sec)"
+    )
+    return rows_loaded
 
 
 def main():
     """
-    Simple command line script to upload csv to postgres db
+    Command line script to backfill a historical csv into postgres db
     Pass csv to be uploaded as command line argument
     """
-    if len(argv) != 2:
-        print(len(argv))
-        print("USAGE: python csv_to_db.py path/to/file.csv")
-        return  # TODO Error
-
-    csv_file = argv[1]
-
-    if csv_file[-4:] != ".csv":
-        print("ERROR helpers.clean_csv: Input file suffix must be .csv")
-        return  # TODO ERROR
-
-    try:
-        # Create the database connection with SQL Alchemy for Pandas to read
-        engine = create_engine(DATABASE_URI)
-    except:
-        print("DB CONNECTION FAILED")
-        return  # TODO Error
-
-    try:
-        df = pd.read_csv(csv_file)
-    except:
-        print("ERROR helpers.clean_csv: Pandas unable to read .csv")
-        return
-    else:
-        wd = WriteData(db_conn=engine)
-
-        df = wd.clean_df(df)  # returns Pandas df
-
-        # datetime data cannot be localized, must be timezone unaware
-        df["vaccination_date"] = pd.to_datetime(df["vaccination_date"])
-        df["vaccination_date"] = df["vaccination_date"].dt.tz_localize(None)
-
-        wd.update_postgres_db(from_csv=True)
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("csv_file", help="path/to/file.csv")
+    parser.add_argument(
+        "--database-uri",
+        default=DATABASE_URI,
+        help="SQLAlchemy database URI (defaults to $DATABASE_URI)",
+    )
+    parser.add_argument("--table", default=DEFAULT_TABLE)
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.csv_file[-4:] != ".csv":
+        parser.error("input file suffix must be .csv")
+
+    if not args.database_uri:
+        parser.error("set DATABASE_URI or pass --database-uri")
+
+    backfill(
+        args.csv_file,
+        args.database_uri,
+        table_name=args.table,
+        chunksize=args.chunksize,
+        workers=args.workers,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,415 @@
+import os
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import datetime as dt
+import threading
+from collections import defaultdict
+
+import numpy as np
+import requests
+import boto3
+
+AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL")
+S3_FILE_NAME_NO_EXTENSION = os.getenv("S3_FILE_NAME_NO_EXTENSION", "vaccines")
+
+# Keys the app reads at startup, the vaccine data is "<name>_clean.csv"
+GEOJSON_KEY = "maryland-counties.geojson"
+CENSUS_KEY = "Population_Estimates_by_County.csv"
+
+COUNTIES = [
+    "Allegany", "Anne Arundel", "Baltimore", "Baltimore City", "Calvert",
+    "Caroline", "Carroll", "Cecil", "Charles", "Dorchester", "Frederick",
+    "Garrett", "Harford", "Howard", "Kent", "Montgomery", "Prince George's",
+    "Queen Anne's", "Somerset", "St. Mary's", "Talbot", "Washington",
+    "Wicomico", "Worcester",
+]
+
+DOSES = [
+    "At Least One Vaccine",
+    "Fully Vaccinated",
+    "First Dose",
+    "Second Dose",
+    "Single Dose",
+]
+
+
+def generate_data(directory: str, name: str, days: int = 120) -> None:
+    """
+    Write synthetic stand-ins for the files the app loads from S3
+    Counties are a grid of squares over Maryland, doses grow daily
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(0)
+
+    features = []
+    for i, county in enumerate(COUNTIES):
+        lon, lat = -79.5 + (i % 6) * 0.7, 37.9 + (i // 6) * 0.4
+        ring = [[lon, lat], [lon + 0.7, lat], [lon + 0.7, lat + 0.4], [lon, lat + 0.4]]
+        features.append(
+            {
+                "type": "Feature",
+                "properties": {"name": county},
+                "geometry": {"type": "Polygon", "coordinates": [ring + ring[:1]]},
+            }
+        )
+    with open(os.path.join(directory, GEOJSON_KEY), "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+    populations = {county: rng.randint(20_000, 1_000_000) for county in COUNTIES}
+    with open(os.path.join(directory, CENSUS_KEY), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["County", "Population"])
+        writer.writerows(populations.items())
+        writer.writerow(["State", sum(populations.values())])
+
+    # Columns as written by the scheduler's clean_df
+    with open(os.path.join(directory, f"{name}_clean.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "vaccination_date", "county", "firstdosecumulative",
+                "seconddosecumulative", "singledosecumulative",
+                "fullvaccinatedcumulative", "atleastonedosecumulative",
+            ]
+        )
+        totals = {county: [0, 0, 0] for county in COUNTIES}
+        start = dt.date(2021, 1, 1)
+        for day in range(days):
+            date = (start + dt.timedelta(days=day)).isoformat()
+            for county, (first, second, single) in totals.items():
+                pop = populations[county]
+                first += rng.randint(0, pop // 400)
+                second += rng.randint(0, max(first - second, 0) // 20)
+                single += rng.randint(0, pop // 4000)
+                totals[county] = [first, second, single]
+                writer.writerow(
+                    [date, county, first, second, single, second + single,
+                     first + single]
+                )
+    print(f"Generated {GEOJSON_KEY}, {CENSUS_KEY} and {name}_clean.csv in {directory}")
+
+
+def seed_s3(directory: str) -> None:
+    """Upload every file in directory to the (local stand-in) S3 bucket"""
+    s3_client = boto3.client("s3", endpoint_url=AWS_S3_ENDPOINT_URL)
+    try:
+        s3_client.create_bucket(Bucket=AWS_S3_BUCKET)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    for file_name in os.listdir(directory):
+        s3_client.upload_file(
+            os.path.join(directory, file_name), AWS_S3_BUCKET, file_name
+        )
+        print(f"Seeded s3://{AWS_S3_BUCKET}/{file_name}")
+
+
+def dash_request(outputs: list, inputs: list) -> dict:
+    """
+    Build a _dash-update-component payload
+    outputs are (id, property) pairs, inputs are (id, property, value)
+    """
+    if len(outputs) == 1:
+        output = "{}.{}".format(*outputs[0])
+        output_specs = {"id": outputs[0][0], "property": outputs[0][1]}
+    else:
+        output = ".." + "...".join(f"{i}.{p}" for i, p in outputs) + ".."
+        output_specs = [{"id": i, "property": p} for i, p in outputs]
+    return {
+        "output": output,
+        "outputs": output_specs,
+        "inputs": [{"id": i, "property": p, "value": v} for i, p, v in inputs],
+        "changedPropIds": [f"{i}.{p}" for i, p, _ in inputs],
+        "state": [],
+    }
+
+
+class DeadlineReached(Exception):
+    """Raised by Session.call once the level's measurement window has closed"""
+
+
+class Session:
+    """One simulated dashboard user"""
+
+    def __init__(
+        self, base_url: str, record, scrubs: int, clicks: int, deadline: float
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.http = requests.Session()
+        self.record = record
+        self.scrubs = scrubs
+        self.clicks = clicks
+        self.deadline = deadline
+
+    def call(self, name: str, method: str, path: str, **kwargs):
+        # Checked before every step so sessions stop with the window
+        if time.perf_counter() >= self.deadline:
+            raise DeadlineReached
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, **kwargs)
+            ok = response.ok
+        except requests.RequestException:
+            response, ok = None, False
+        end = time.perf_counter()
+        # Requests still in flight when the window closed are not counted
+        if end >= self.deadline:
+            raise DeadlineReached
+        self.record(name, end - start, ok)
+        return response if ok else None
+
+    def callback(self, name: str, payload: dict) -> dict:
+        response = self.call(name, "POST", "/_dash-update-component", json=payload)
+        return response.json()["response"] if response is not None else {}
+
+    def run(self) -> None:
+        # Page load
+        for path in ["/", "/_dash-layout", "/_dash-dependencies"]:
+            if self.call("page_load", "GET", path) is None:
+                return
+
+        store = self.callback(
+            "update_df",
+            dash_request([("store", "data")], [("onload", "children", None)]),
+        ).get("store", {}).get("data")
+        if store is None:
+            return
+
+        slider = self.callback(
+            "render_slider",
+            dash_request(
+                [
+                    ("selected-date-index", prop)
+                    for prop in ["min", "max", "value", "marks"]
+                ],
+                [("store", "data", store)],
+            ),
+        ).get("selected-date-index", {})
+        date_min, date_max = slider.get("min", 0), slider.get("max", 0)
+
+        state = {
+            "date": date_max,
+            "dose": DOSES[0],
+            "mode": "Absolute",
+            "click": None,
+            "compare": None,
+        }
+        counties = []
+
+        def choropleth():
+            figure = self.callback(
+                "display_choropleth",
+                dash_request(
+                    [("choropleth", "figure")],
+                    [
+                        ("selected-date-index", "value", state["date"]),
+                        ("selected-dose", "value", state["dose"]),
+                        ("select-absolute-relative", "value", state["mode"]),
+                        ("store", "data", store),
+                    ],
+                ),
+            ).get("choropleth", {}).get("figure")
+            if figure and not counties:
+                counties.extend(figure["data"][0].get("locations", []))
+
+        def stats():
+            self.callback(
+                "display_stats",
+                dash_request(
+                    [
+                        ("state-stats", "children"),
+                        ("output-date-location", "children"),
+                        ("output-table", "columns"),
+                        ("output-table", "data"),
+                    ],
+                    [
+                        ("selected-date-index", "value", state["date"]),
+                        ("choropleth", "clickData", state["click"]),
+                        ("select-absolute-relative", "value", state["mode"]),
+                        ("store", "data", store),
+                    ],
+                ),
+            )
+
+        def comparison():
+            self.callback(
+                "display_comparison",
+                dash_request(
+                    [
+                        ("compare-table", "columns"),
+                        ("compare-table", "data"),
+                        ("compare-timeseries", "figure"),
+                    ],
+                    [
+                        ("selected-date-index", "value", state["date"]),
+                        ("compare-counties", "value", state["compare"]),
+                        ("selected-dose", "value", state["dose"]),
+                        ("select-absolute-relative", "value", state["mode"]),
+                        ("store", "data", store),
+                    ],
+                ),
+            )
+
+        choropleth()
+        stats()
+        comparison()
+
+        # Pick counties to compare, so later comparisons do real work
+        if counties:
+            if random.random() < 0.5:
+                state["compare"] = ["ALL"]
+            else:
+                state["compare"] = random.sample(counties, min(3, len(counties)))
+            comparison()
+
+        # Scrub the slider, occasionally switching dose and absolute/relative
+        for _ in range(self.scrubs):
+            state["date"] = random.randint(date_min, date_max)
+            if random.random() < 0.2:
+                state["dose"] = random.choice(DOSES)
+            if random.random() < 0.2:
+                state["mode"] = random.choice(["Absolute", "Relative"])
+            choropleth()
+            stats()
+            comparison()
+
+        # Click counties on the map
+        for _ in range(self.clicks if counties else 0):
+            state["click"] = {"points": [{"location": random.choice(counties)}]}
+            stats()
+
+
+def worker_pids(master_pid: int) -> list:
+    """Child processes of the gunicorn master, read from /proc"""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # ppid is the 4th field, after the parenthesised command name
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == master_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def run_level(args, users: int) -> None:
+    """Run `users` concurrent sessions for args.duration seconds and print a report"""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def record(name, seconds, ok):
+        with lock:
+            latencies[name].append(seconds)
+            if not ok:
+                errors[name] += 1
+
+    deadline = time.perf_counter() + args.duration
+    stop = threading.Event()
+
+    def user():
+        try:
+            while True:
+                Session(args.url, record, args.scrubs, args.clicks, deadline).run()
+        except DeadlineReached:
+            pass
+
+    peak_rss = defaultdict(float)
+
+    def sample_rss():
+        while not stop.wait(0.5):
+            for pid in worker_pids(args.gunicorn_pid):
+                peak_rss[pid] = max(peak_rss[pid], rss_mb(pid))
+
+    sampler = None
+    if args.gunicorn_pid:
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+    threads = [threading.Thread(target=user) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    if sampler:
+        sampler.join()
+
+    # Only requests completed inside the window are recorded, so it is the divisor
+    total = sum(len(v) for v in latencies.values())
+    print(f"\n=== {users} concurrent users, {args.duration:.1f}s ===")
+    print(
+        f"throughput: {total / args.duration:.1f} req/s, "
+        f"errors: {sum(errors.values())}"
+    )
+    print(f"{'request':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(latencies.items()):
+        p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+        print(f"{name:<20}{len(values):>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+    for pid, rss in sorted(peak_rss.items()):
+        print(f"worker {pid}: peak RSS {rss:.1f} MB")
+
+
+def main():
+    """
+    Simulate concurrent dashboard users against a locally running app
+    Reports throughput, latency percentiles and gunicorn worker memory per level
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument(
+        "--users", type=int, nargs="*", default=[1, 5, 10, 20],
+        help="concurrent user counts to run, one level after another "
+        "(pass none to only seed S3)",
+    )
+    parser.add_argument("--duration", type=float, default=30, help="seconds per level")
+    parser.add_argument("--scrubs", type=int, default=10, help="slider moves per session")
+    parser.add_argument("--clicks", type=int, default=5, help="county clicks per session")
+    parser.add_argument(
+        "--gunicorn-pid", type=int, help="gunicorn master pid, to sample worker RSS"
+    )
+    parser.add_argument(
+        "--generate-data", metavar="DIR",
+        help=f"write synthetic {GEOJSON_KEY}, {CENSUS_KEY} and "
+        "$S3_FILE_NAME_NO_EXTENSION_clean.csv to DIR first",
+    )
+    parser.add_argument(
+        "--seed-s3", metavar="DIR",
+        help="upload DIR to the local S3 stand-in (AWS_S3_ENDPOINT_URL) first",
+    )
+    args = parser.parse_args()
+
+    if args.generate_data:
+        generate_data(args.generate_data, S3_FILE_NAME_NO_EXTENSION)
+
+    if args.seed_s3:
+        if not AWS_S3_ENDPOINT_URL:
+            print("ERROR load_test: set AWS_S3_ENDPOINT_URL to a local S3 stand-in")
+            sys.exit(1)
+        seed_s3(args.seed_s3)
+
+    for users in args.users:
+        run_level(args, users)
+
+
+if __name__ == "__main__":
+    main()
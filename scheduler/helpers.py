@@ -1,11 +1,50 @@
 import io
+import gzip
+import json
+import time
+import difflib
+import hashlib
 import datetime as dt
-from typing import Union
+from contextlib import contextmanager
+from typing import Dict, List, Union
 
 import sqlalchemy
 import requests
 import pandas as pd
-from urllib.error import HTTPError
+from botocore.exceptions import ClientError
+
+# Keys used in S3 object metadata to detect unchanged source data between runs
+HASH_META_KEY = "content-sha256"
+ETAG_META_KEY = "source-etag"
+LAST_MODIFIED_META_KEY = "source-last-modified"
+
+
+def is_missing(error: ClientError) -> bool:
+    """True if an S3 ClientError means the object does not exist"""
+    code = error.response.get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+# Every Nth snapshot version is stored in full instead of as a delta
+SNAPSHOT_CHECKPOINT_EVERY = 30
+
+
+def diff_lines(base: List[str], new: List[str]) -> dict:
+    """
+    Row-level delta turning base into new
+    "removed" holds [start, end) ranges of base rows to drop,
+    "added" holds [position in new, row] pairs to insert
+    """
+    # autojunk would treat frequent rows as unmatchable and bloat the delta
+    matcher = difflib.SequenceMatcher(None, base, new, autojunk=False)
+    removed = []
+    added = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ("replace", "delete"):
+            removed.append([i1, i2])
+        if tag in ("replace", "insert"):
+            added.extend([j, new[j]] for j in range(j1, j2))
+    return {"removed": removed, "added": added}
 
 
 class WriteData:
@@ -16,6 +55,190 @@ class WriteData:
     ):
         self.s3_resource = s3_resource
         self.db_conn = db_conn
+        self.metrics = self.new_metrics()
+
+    @staticmethod
+    def new_metrics() -> dict:
+        """Empty per-run metrics record"""
+        return {
+            "bytes_fetched": 0,
+            "bytes_written": 0,
+            "s3_puts": 0,
+            "s3_puts_skipped": 0,
+            "source_not_modified": False,
+            "stage_seconds": {},
+        }
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Add the wall time spent inside the block to metrics["stage_seconds"]"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.metrics["stage_seconds"]
+            stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - start
+
+    def get_s3_metadata(self, bucket_name: str, key: str) -> Dict[str, str]:
+        """Return user metadata of an S3 object, or an empty dict if it does not exist"""
+        try:
+            head = self.s3_resource.meta.client.head_object(Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            if is_missing(e):
+                return {}
+            raise
+        return head.get("Metadata", {})
+
+    def update_s3_metadata(
+        self, bucket_name: str, key: str, metadata: Dict[str, str]
+    ) -> bool:
+        """
+        Merge metadata into an existing S3 object's user metadata
+        Uses a server-side copy, the body is not uploaded again
+        """
+        try:
+            client = self.s3_resource.meta.client
+            head = client.head_object(Bucket=bucket_name, Key=key)
+            stored = head.get("Metadata", {})
+            if all(stored.get(k) == v for k, v in metadata.items()):
+                return True
+
+            client.copy_object(
+                Bucket=bucket_name,
+                Key=key,
+                CopySource={"Bucket": bucket_name, "Key": key},
+                Metadata=dict(stored, **metadata),
+                MetadataDirective="REPLACE",
+                ContentType=head.get("ContentType", "binary/octet-stream"),
+            )
+            return True
+
+        except ClientError as e:
+            print(f"ERROR: Could not update metadata of {key}: {e}")
+            return False
+
+    def fetch_source(
+        self, url: str, etag: str = None, last_modified: str = None
+    ) -> Union[requests.Response, None]:
+        """
+        Conditional GET on the source url
+        Returns None if the server reports the data has not changed (HTTP 304)
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        response = requests.get(url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        self.metrics["bytes_fetched"] += len(response.content)
+        return response
+
+    def get_s3_object(self, bucket_name: str, key: str) -> Union[dict, None]:
+        """Return the get_object response of an S3 object, or None if missing"""
+        try:
+            return self.s3_resource.Object(bucket_name, key).get()
+        except ClientError as e:
+            # Anything but a missing object (e.g. AccessDenied, throttling) must not
+            # look like an empty manifest, or the snapshot history is overwritten
+            if is_missing(e):
+                return None
+            raise
+
+    def get_s3_bytes(self, bucket_name: str, key: str) -> Union[bytes, None]:
+        """Return the body of an S3 object, or None if it does not exist"""
+        obj = self.get_s3_object(bucket_name, key)
+        return obj["Body"].read() if obj is not None else None
+
+    def put_s3_bytes(
+        self, bucket_name: str, key: str, body: bytes, metadata: Dict[str, str] = None
+    ) -> None:
+        self.s3_resource.Object(bucket_name, key).put(
+            Body=body, Metadata=metadata or {}
+        )
+        self.metrics["bytes_written"] += len(body)
+        self.metrics["s3_puts"] += 1
+
+    def publish_snapshot(
+        self, df: pd.DataFrame, bucket_name: str, dataset: str
+    ) -> Union[int, None]:
+        """
+        Record df as a new version of dataset under "<dataset>_snapshots/"
+        Versions are stored as content-addressed row deltas against the previous
+        version, with a full checkpoint every SNAPSHOT_CHECKPOINT_EVERY versions
+        Returns the new version number, or None if df matches the latest version
+        """
+        prefix = f"{dataset}_snapshots/"
+        text = df.to_csv(index=False)
+        content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+        manifest_body = self.get_s3_bytes(bucket_name, f"{prefix}manifest.json")
+        manifest = json.loads(manifest_body) if manifest_body else {"versions": []}
+        versions = manifest["versions"]
+        if versions and versions[-1]["hash"] == content_hash:
+            return None
+
+        version = len(versions)
+        lines = text.splitlines()
+        # The latest version is kept whole so the next delta needs a single read
+        head = self.get_s3_object(bucket_name, f"{prefix}head.csv.gz")
+
+        full_body = gzip.compress(text.encode("utf-8"))
+        kind = "checkpoint"
+        key = f"{prefix}objects/{content_hash}.csv.gz"
+        body = full_body
+
+        # Head is written before the manifest, so a run interrupted in between
+        # leaves a head that is not the latest version. A delta is only valid
+        # against the content it was built on
+        head_is_latest = (
+            head is not None
+            and versions
+            and head.get("Metadata", {}).get(HASH_META_KEY) == versions[-1]["hash"]
+        )
+
+        if version % SNAPSHOT_CHECKPOINT_EVERY != 0 and head_is_latest:
+            base = gzip.decompress(head["Body"].read()).decode("utf-8").splitlines()
+            delta = diff_lines(base[1:], lines[1:])
+            delta["header"] = lines[0]
+            delta_body = gzip.compress(json.dumps(delta).encode("utf-8"), mtime=0)
+            # A delta larger than the whole version is stored as a checkpoint instead
+            if len(delta_body) < len(full_body):
+                kind = "delta"
+                body = delta_body
+                # Addressed by the delta itself, the same content may recur on
+                # another base
+                delta_hash = hashlib.sha256(body).hexdigest()
+                key = f"{prefix}objects/{delta_hash}.delta.json.gz"
+
+        self.put_s3_bytes(bucket_name, key, body)
+        self.put_s3_bytes(
+            bucket_name,
+            f"{prefix}head.csv.gz",
+            full_body,
+            metadata={HASH_META_KEY: content_hash},
+        )
+
+        versions.append(
+            {
+                "version": version,
+                "hash": content_hash,
+                "type": kind,
+                "key": key,
+                "rows": len(lines) - 1,
+                "created": dt.datetime.utcnow().isoformat(timespec="seconds"),
+            }
+        )
+        # Manifest is written last so readers never see a version without its object
+        self.put_s3_bytes(
+            bucket_name,
+            f"{prefix}manifest.json",
+            json.dumps(manifest, indent=1).encode("utf-8"),
+        )
+        return version
 
     # Clean up the data in pandas
     def clean_df(self, df: pd.DataFrame) -> Union[pd.DataFrame, None]:
@@ -41,18 +264,31 @@ class WriteData:
     def upload_df_to_s3_as_csv(
         self, df: pd.DataFrame, bucket_name: str, file_name_no_extension: str
     ) -> bool:
-        """Upload a datafrom to a a given S3 bucket after creating resource in class"""
+        """
+        Upload a datafrom to a a given S3 bucket after creating resource in class
+        The upload is skipped if the stored object already has the same content hash
+        """
         try:
             csv_buffer = io.StringIO()
             df.to_csv(csv_buffer)
+            body = csv_buffer.getvalue().encode("utf-8")
+            content_hash = hashlib.sha256(body).hexdigest()
+
+            stored = self.get_s3_metadata(bucket_name, file_name_no_extension)
+            if stored.get(HASH_META_KEY) == content_hash:
+                self.metrics["s3_puts_skipped"] += 1
+                return True
+
             self.s3_resource.Object(bucket_name, file_name_no_extension).put(
-                Body=csv_buffer.getvalue()
+                Body=body, Metadata={HASH_META_KEY: content_hash}
             )
+            self.metrics["bytes_written"] += len(body)
+            self.metrics["s3_puts"] += 1
             return True
 
         except:
             print(
-                "ERROR: Could not upload raw to S3.",
+                f"ERROR: Could not upload {file_name_no_extension} to S3.",
                 "Did you create an S3 resource when instantiating the class?"
             )
             return False
@@ -60,32 +296,80 @@ class WriteData:
     def update_s3_df(
         self, url: str, bucket_name: str, s3_file_name_no_extension: str
     ) -> bool:
-        """Upload Pandas df as csv to AWS S3"""
+        """
+        Upload Pandas df as csv to AWS S3
+        The source validators (ETag/Last-Modified) from the previous successful run
+        are kept in the raw object's metadata so unchanged source data is not
+        downloaded again
+        Returns False if any stage failed
+        """
         if not self.s3_resource:
             print("Must define s3_resource on class instantiation")
             return False
+
+        self.metrics = self.new_metrics()
+        raw_key = f"{s3_file_name_no_extension}_raw.csv"
         try:
-            df = pd.read_csv(url)  # Pandas reads directly from URL input
-            # Upload raw data into data lake for archiving
-            self.upload_df_to_s3_as_csv(
-                df, bucket_name, f"{s3_file_name_no_extension}_raw.csv"
-            )
+            with self.timed("fetch"):
+                stored = self.get_s3_metadata(bucket_name, raw_key)
+                response = self.fetch_source(
+                    url,
+                    etag=stored.get(ETAG_META_KEY),
+                    last_modified=stored.get(LAST_MODIFIED_META_KEY),
+                )
 
-        except HTTPError as e:
+        except requests.RequestException as e:
             # TODO Email Admin with error summary
             print(e)
             return False
 
-        else:
+        if response is None:
+            self.metrics["source_not_modified"] = True
+            print("Source data not modified since last run")
+            return True
+
+        validators = {}
+        if response.headers.get("ETag"):
+            validators[ETAG_META_KEY] = response.headers["ETag"]
+        if response.headers.get("Last-Modified"):
+            validators[LAST_MODIFIED_META_KEY] = response.headers["Last-Modified"]
+
+        with self.timed("parse"):
+            df = pd.read_csv(io.BytesIO(response.content))
+
+        with self.timed("upload_raw"):
+            # Upload raw data into data lake for archiving
+            if not self.upload_df_to_s3_as_csv(df, bucket_name, raw_key):
+                return False
+
+        with self.timed("snapshot_raw"):
+            self.publish_snapshot(df, bucket_name, f"{s3_file_name_no_extension}_raw")
+
+        with self.timed("clean"):
             df = self.clean_df(df)
+
+        with self.timed("upload_clean"):
             # Upload clean data for use in web app
-            self.upload_df_to_s3_as_csv(
+            if not self.upload_df_to_s3_as_csv(
                 df, bucket_name, f"{s3_file_name_no_extension}_clean.csv"
+            ):
+                return False
+
+        # Only reached once the clean csv is published, so history matches it
+        with self.timed("snapshot_clean"):
+            self.publish_snapshot(
+                df, bucket_name, f"{s3_file_name_no_extension}_clean"
             )
 
+        # Validators are saved last: if any stage above failed, the next run
+        # downloads the source again instead of getting a 304 for stale output
+        with self.timed("save_validators"):
+            if not self.update_s3_metadata(bucket_name, raw_key, validators):
+                return False
+
         return True
 
-    def update_postgres_db(self, from_csv: bool = False) -> bool:
+    def update_postgres_db(self) -> bool:
         """
         Update postgres db for archival purposes
         Clean data before uploading
@@ -126,13 +410,8 @@ class WriteData:
         df["vaccination_date"] = pd.to_datetime(df["vaccination_date"], unit="ms")
         df["vaccination_date"] = df["vaccination_date"].dt.tz_localize(None)
 
-        if from_csv:
-            # First write to db
-            df.to_sql("vaccines", self.db_conn)
-
-        else:
-            # Append data to postgres database
-            df.to_sql("vaccines", self.db_conn, if_exists="append")
+        # Append data to postgres database (first loaded by csv_to_db.py)
+        df.to_sql("vaccines", self.db_conn, if_exists="append")
 
         print(df)
         print("SUCCESSFULLY UPDATED DATABASE")
@@ -1,7 +1,14 @@
 import os
+import sys
+import json
+import time
+import uuid
+import socket
+import random
 import boto3
 import boto3.session
-from helpers import WriteData
+from botocore.exceptions import ClientError
+from helpers import WriteData, is_missing
 
 DATA_URL = "https://opendata.arcgis.com/datasets/89c9c1236ca848188d93beb5928f4162_0.csv"
 ACCESS_ID = os.getenv("AWS_ACCESS_KEY_ID")
@@ -9,8 +16,82 @@ ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
 S3_FILE_NAME_NO_EXTENSION = os.getenv("S3_FILE_NAME_NO_EXTENSION")
 
+# Daemon mode settings (seconds)
+SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", 24 * 60 * 60))
+SCHEDULER_BACKOFF_BASE = int(os.getenv("SCHEDULER_BACKOFF_BASE", 60))
+SCHEDULER_BACKOFF_MAX = int(os.getenv("SCHEDULER_BACKOFF_MAX", 60 * 60))
+
+# Lease object in the bucket shared by every run, whatever container it is in
+SCHEDULER_LOCK_KEY = os.getenv("SCHEDULER_LOCK_KEY", "scheduler.lock")
+# A lease older than this is considered abandoned (e.g. the run was killed)
+SCHEDULER_LOCK_TTL = int(os.getenv("SCHEDULER_LOCK_TTL", 60 * 60))
+
+
+def is_precondition_failed(error: ClientError) -> bool:
+    """True if a conditional S3 write lost to another writer"""
+    code = error.response.get("Error", {}).get("Code")
+    return code in ("PreconditionFailed", "ConditionalRequestConflict")
+
+
+def acquire_lock(
+    s3_client,
+    bucket_name: str = AWS_S3_BUCKET,
+    key: str = SCHEDULER_LOCK_KEY,
+    ttl: int = SCHEDULER_LOCK_TTL,
+):
+    """
+    Take the lease object with a conditional put so runs never overlap
+    An expired lease is taken over, conditional on it not having changed
+    Returns the ETag of our lease (needed to release it) or None if held
+    """
+    body = json.dumps(
+        {
+            "owner": f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}",
+            "expires": time.time() + ttl,
+        }
+    ).encode("utf-8")
+
+    try:
+        lease = s3_client.put_object(
+            Bucket=bucket_name, Key=key, Body=body, IfNoneMatch="*"
+        )
+        return lease["ETag"]
+    except ClientError as e:
+        if not is_precondition_failed(e):
+            raise
 
-def main():
+    try:
+        held = s3_client.get_object(Bucket=bucket_name, Key=key)
+        if json.load(held["Body"])["expires"] > time.time():
+            return None
+        lease = s3_client.put_object(
+            Bucket=bucket_name, Key=key, Body=body, IfMatch=held["ETag"]
+        )
+        return lease["ETag"]
+    except ClientError as e:
+        # Released or taken over by another run in the meantime
+        if is_precondition_failed(e) or is_missing(e):
+            return None
+        raise
+
+
+def release_lock(
+    s3_client,
+    etag: str,
+    bucket_name: str = AWS_S3_BUCKET,
+    key: str = SCHEDULER_LOCK_KEY,
+) -> None:
+    """Delete the lease, unless it expired and another run has taken it over"""
+    try:
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError:
+        return
+    if head["ETag"] == etag:
+        s3_client.delete_object(Bucket=bucket_name, Key=key)
+
+
+def run_once() -> bool:
+    """Run a single S3 update, print its metrics and return whether it succeeded"""
     try:
         session = boto3.session.Session(
             aws_access_key_id=ACCESS_ID, aws_secret_access_key=ACCESS_KEY
@@ -18,16 +99,70 @@ def main():
         s3_resource = session.resource("s3")
     except:
         print("FAILED TO CONNECT TO S3")
-    else:
-        wd = WriteData(s3_resource=s3_resource)
+        return False
+
+    s3_client = s3_resource.meta.client
     try:
-        wd.update_s3_df(
-            DATA_URL, AWS_S3_BUCKET, s3_file_name_no_extension=S3_FILE_NAME_NO_EXTENSION
-        )
-        print("SUCCESS: S3 UPDATED")
-    except:
-        print("S3 WRITE FAILED")
+        lease = acquire_lock(s3_client)
+    except ClientError as e:
+        print(f"FAILED TO TAKE SCHEDULER LOCK: {e}")
+        return False
+    if lease is None:
+        print("SKIPPED: another scheduler run is in progress")
+        return True
+
+    try:
+        wd = WriteData(s3_resource=s3_resource)
+        start = time.perf_counter()
+        try:
+            success = wd.update_s3_df(
+                DATA_URL,
+                AWS_S3_BUCKET,
+                s3_file_name_no_extension=S3_FILE_NAME_NO_EXTENSION,
+            )
+        except:
+            success = False
+
+        wd.metrics["success"] = success
+        wd.metrics["total_seconds"] = time.perf_counter() - start
+        print(json.dumps(wd.metrics))
+
+        if success:
+            print("SUCCESS: S3 UPDATED")
+        else:
+            print("S3 WRITE FAILED")
+        return success
+
+    finally:
+        release_lock(s3_client, lease)
+
+
+def backoff_delay(failures: int) -> float:
+    """Exponential backoff with full jitter, capped at SCHEDULER_BACKOFF_MAX"""
+    ceiling = min(SCHEDULER_BACKOFF_MAX, SCHEDULER_BACKOFF_BASE * 2 ** (failures - 1))
+    return random.uniform(0, ceiling)
+
+
+def daemon():
+    """Run forever: every SCHEDULER_INTERVAL on success, backing off on failure"""
+    failures = 0
+    while True:
+        if run_once():
+            failures = 0
+            delay = SCHEDULER_INTERVAL
+        else:
+            failures += 1
+            delay = backoff_delay(failures)
+        print(f"Next run in {delay:.0f}s")
+        time.sleep(delay)
+
+
+def main() -> bool:
+    return run_once()
 
 
 if __name__ == "__main__":
-    main()
+    if "--daemon" in sys.argv[1:]:
+        daemon()
+    elif not main():
+        sys.exit(1)
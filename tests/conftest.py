@@ -0,0 +1,31 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# app/ and scheduler/ are deployed as separate flat containers
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("app", "scheduler"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_S3_BUCKET", "test-bucket")
+
+BUCKET = os.environ["AWS_S3_BUCKET"]
+
+
+@pytest.fixture
+def s3_resource(monkeypatch):
+    """moto S3 with an empty BUCKET, and a fresh shared client in data_utils"""
+    import data_utils
+
+    with mock_aws():
+        resource = boto3.resource("s3", region_name="us-east-1")
+        resource.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(data_utils, "_s3_client", None)
+        yield resource
@@ -0,0 +1,160 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_utils import CallbackUtils, MemoCache
+
+COUNTIES = ["Allegany", "Anne Arundel", "Baltimore", "Calvert"]
+FEATURES = [
+    "First Dose",
+    "Second Dose",
+    "Single Dose",
+    "At Least One Vaccine",
+    "Fully Vaccinated",
+]
+
+
+def vaccine_df(seed: int = 0, days: int = 5) -> pd.DataFrame:
+    """Shaped like LoadS3.etl_pipeline output: one row per date and county"""
+    rng = random.Random(seed)
+    rows = []
+    for day in pd.date_range("2021-01-01", periods=days):
+        for county in COUNTIES:
+            row = {"date": day, "County": county}
+            row.update({f: rng.randint(0, 10_000) for f in FEATURES})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def cb():
+    census = pd.DataFrame(
+        {
+            "County": COUNTIES + ["State"],
+            "Population": [70_000, 580_000, 830_000, 92_000, 6_000_000],
+        }
+    )
+    return CallbackUtils(census_data=census)
+
+
+def test_memo_cache_evicts_least_recently_used():
+    cache = MemoCache(maxsize=2)
+    cache.get_or_compute("a", lambda: 1)
+    cache.get_or_compute("b", lambda: 2)
+    assert cache.get_or_compute("a", lambda: pytest.fail("a was cached")) == 1
+
+    cache.get_or_compute("c", lambda: 3)  # evicts "b", used longest ago
+    assert cache.get_or_compute("a", lambda: pytest.fail("a was cached")) == 1
+    assert cache.get_or_compute("b", lambda: 20) == 20
+    assert cache.info() == {"hits": 2, "misses": 4, "size": 2, "maxsize": 2}
+
+
+def test_dataset_version_falls_back_to_content_hash(cb):
+    df = vaccine_df()
+    version = cb.dataset_version(df)
+    assert df.attrs["version"] == version
+    assert cb.dataset_version(vaccine_df()) == version
+
+    changed = vaccine_df()
+    changed.loc[0, "First Dose"] += 1
+    assert cb.dataset_version(changed) != version
+
+    df.attrs["version"] = '"etag"'
+    assert cb.dataset_version(df) == '"etag"'
+
+
+def test_new_dataset_version_is_not_served_from_cache(cb):
+    old, new = vaccine_df(0), vaccine_df(1)
+    old.attrs["version"], new.attrs["version"] = "v1", "v2"
+    cb.cached_county_stats(old, 4)
+    cb.cached_state_stats(old, 4)
+
+    misses = cb.cache.info()["misses"]
+    pd.testing.assert_frame_equal(
+        cb.cached_county_stats(new, 4),
+        cb.get_county_stats(cb.filter_by_date(new, cb.get_slider_date(new, 4))),
+    )
+    assert cb.cached_state_stats(new, 4) == cb.get_state_stats(
+        cb.filter_by_date(new, cb.get_slider_date(new, 4))
+    )
+    assert cb.cache.info()["misses"] > misses
+
+
+@pytest.mark.parametrize("percent", [False, True])
+def test_county_click_reuses_cached_results(cb, percent):
+    df = vaccine_df()
+    # Slider move: display_choropleth and display_stats
+    cb.cached_county_stats(df, 2, percent=percent)
+    cb.cached_slider_date(df, 2)
+    cb.cached_state_stats(df, 2, percent=percent)
+    misses = cb.cache.info()["misses"]
+
+    # County click: display_stats alone
+    cb.cached_slider_date(df, 2)
+    cb.cached_state_stats(df, 2, percent=percent)
+    stats = cb.cached_county_stats(df, 2, percent=percent)
+    cb.filter_by_county(stats, "Baltimore")
+
+    assert cb.cache.info()["misses"] == misses
+    assert cb.cache.info()["hits"] >= 3
+
+
+@pytest.mark.parametrize("percent", [False, True])
+def test_cached_results_match_uncached_path(cb, percent):
+    df = vaccine_df()
+    for index in cb.get_numdate(df):
+        dff = cb.filter_by_date(df, cb.get_slider_date(df, index))
+
+        assert cb.cached_slider_date(df, index) == cb.get_slider_date(df, index)
+        pd.testing.assert_frame_equal(cb.cached_date_slice(df, index), dff)
+        pd.testing.assert_frame_equal(
+            cb.cached_county_stats(df, index, percent=percent),
+            cb.get_county_stats(dff, percent=percent),
+        )
+        np.testing.assert_allclose(
+            cb.cached_state_stats(df, index, percent=percent),
+            cb.get_state_stats(dff, percent=percent),
+        )
+
+
+@pytest.mark.parametrize("percent", [False, True])
+def test_comparison_matches_per_county_path(cb, percent):
+    df = vaccine_df()
+    counties = cb.get_counties()
+    for index in cb.get_numdate(df):
+        table = cb.get_comparison(df, counties, index, "First Dose", percent=percent)
+        assert table["County"].tolist() == counties
+
+        dff = cb.filter_by_date(df, cb.get_slider_date(df, index))
+        stats = cb.get_county_stats(dff, percent=percent)
+        for county in counties:
+            expected = cb.filter_by_county(stats, county).iloc[0]
+            row = table.set_index("County").loc[county, FEATURES]
+            np.testing.assert_allclose(row.astype(float), expected.astype(float))
+
+
+def test_comparison_rank_and_percentile(cb):
+    df = vaccine_df()
+    df.loc[df["date"] == df["date"].max(), "Second Dose"] = [30, 10, 30, 20]
+    counties = ["Allegany", "Anne Arundel", "Baltimore", "Calvert"]
+
+    table = cb.get_comparison(df, counties, 4, "Second Dose").set_index("County")
+    assert table["Rank"].tolist() == [1, 4, 1, 3]  # ties share the higher rank
+    assert table["Percentile"].tolist() == [0.875, 0.25, 0.875, 0.5]
+    assert table["Population"].tolist() == [70_000, 580_000, 830_000, 92_000]
+
+    # Ranks are across the selection only
+    subset = cb.get_comparison(df, ["Anne Arundel", "Calvert"], 4, "Second Dose")
+    assert subset["Rank"].tolist() == [2, 1]
+    assert subset["Percentile"].tolist() == [0.5, 1.0]
+
+
+def test_comparison_timeseries(cb):
+    df = vaccine_df()
+    history = cb.get_comparison_timeseries(df, ["Calvert", "Allegany"], "First Dose")
+    expected = df[df["County"].isin(["Calvert", "Allegany"])]
+    merged = history.merge(expected, on=["date", "County"], suffixes=("", "_df"))
+    assert len(merged) == len(expected) == len(history)
+    assert (merged["First Dose"] == merged["First Dose_df"]).all()
@@ -0,0 +1,125 @@
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import csv_to_db
+
+# The gap in the third row becomes a float column in that chunk's clean_df
+CSV = """VACCINATION_DATE,County,FirstDoseCumulative,SecondDoseCumulative
+2021-01-01,Allegany ,10,1
+2021-01-01,Anne Arundel,20,2
+2021-01-02,Allegany ,30,
+2021-01-02,Anne Arundel,40,4
+2021-01-03,Allegany ,50,5
+"""
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "history.csv"
+    path.write_text(CSV)
+    return str(path)
+
+
+@pytest.fixture
+def database_uri(tmp_path):
+    return f"sqlite:///{tmp_path / 'vaccines.db'}"
+
+
+def test_backfill_loads_all_chunks_and_resumes(csv_file, database_uri):
+    assert csv_to_db.backfill(csv_file, database_uri, chunksize=2, workers=1) == 5
+
+    df = pd.read_sql_table("vaccines", create_engine(database_uri))
+    assert len(df) == 5
+    assert sorted(df["county"].unique()) == ["Allegany", "Anne Arundel"]
+    assert df["seconddosecumulative"].tolist() == [1, 2, 0, 4, 5]
+
+    # Every chunk is checkpointed, so a rerun loads nothing twice
+    assert csv_to_db.backfill(csv_file, database_uri, chunksize=2, workers=1) == 0
+    assert len(pd.read_sql_table("vaccines", create_engine(database_uri))) == 5
+
+
+def test_chunk_with_gap_matches_integer_table(
+    csv_file, database_uri, monkeypatch
+):
+    # Table created from a chunk without gaps, so the column is an integer
+    first = csv_to_db.prep_chunk(pd.read_csv(csv_file, nrows=2))
+    first.head(0).to_sql("vaccines", create_engine(database_uri))
+    int_columns = csv_to_db.integer_columns(create_engine(database_uri), "vaccines")
+    assert "seconddosecumulative" in int_columns
+
+    # SQLite coerces 0.0 itself, so check what would be handed to COPY
+    loaded = []
+    to_sql = pd.DataFrame.to_sql
+
+    def spy(df, *args, **kwargs):
+        loaded.append(df.dtypes["seconddosecumulative"])
+        return to_sql(df, *args, **kwargs)
+
+    monkeypatch.setattr(pd.DataFrame, "to_sql", spy)
+    chunk = pd.read_csv(csv_file, skiprows=range(1, 3), nrows=2)
+    csv_to_db.metadata.create_all(create_engine(database_uri))
+    csv_to_db.load_chunk(database_uri, "vaccines", int_columns, "test", 1, chunk)
+    assert loaded == ["int64"]
+
+
+def test_resume_key_depends_on_content(tmp_path, csv_file, database_uri):
+    csv_to_db.backfill(csv_file, database_uri, chunksize=2, workers=1)
+
+    # Same name and size, different content
+    with open(csv_file) as f:
+        text = f.read()
+    with open(csv_file, "w") as f:
+        f.write(text.replace("50", "60"))
+
+    assert csv_to_db.backfill(csv_file, database_uri, chunksize=2, workers=1) == 5
+
+
+def test_match_column_types_casts_whole_floats():
+    df = pd.DataFrame({"a": [1.0, 0.0], "b": [1.5, 2.0]})
+    df = csv_to_db.match_column_types(df, ["a"])
+    assert df["a"].dtype == "int64"
+    assert df["b"].dtype == "float64"
+
+    with pytest.raises(ValueError):
+        csv_to_db.match_column_types(df, ["b"])
+
+
+def test_bad_arguments_exit_nonzero(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["csv_to_db.py", "history.txt"])
+    with pytest.raises(SystemExit) as exit_info:
+        csv_to_db.main()
+    assert exit_info.value.code != 0
+
+
+@pytest.mark.parametrize(
+    "schema, name, expected",
+    [
+        (None, "vaccines", '"vaccines"'),
+        (None, "Vaccines", '"Vaccines"'),
+        (None, "order", '"order"'),
+        ("Archive", "user", '"Archive"."user"'),
+    ],
+)
+def test_copy_quotes_table_and_schema(schema, name, expected):
+    statements = []
+
+    class Cursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+        def copy_expert(self, sql, buffer):
+            statements.append((sql, buffer.read()))
+
+    conn = SimpleNamespace(connection=SimpleNamespace(cursor=Cursor))
+    table = SimpleNamespace(schema=schema, name=name)
+    csv_to_db.psql_insert_copy(table, conn, ["County", "first dose"], [("a", 1)])
+
+    assert statements == [
+        (f'COPY {expected} ("County", "first dose") FROM STDIN WITH CSV', "a,1\r\n")
+    ]
@@ -0,0 +1,142 @@
+import io
+import random
+
+import pandas as pd
+import pytest
+from flask import Flask
+
+from geo_utils import CountyIndex, STRtree, county_api
+
+
+def square(minx, miny, maxx, maxy):
+    return [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+
+
+# Coordinates are [lon, lat] as in GeoJSON
+GEOJSON = {
+    "type": "FeatureCollection",
+    "features": [
+        {  # A square with a hole in the middle
+            "properties": {"name": "Holed"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [square(0, 0, 10, 10), square(4, 4, 6, 6)],
+            },
+        },
+        {  # Sits inside the hole of "Holed"
+            "properties": {"name": "Island"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [square(4.5, 4.5, 5.5, 5.5)],
+            },
+        },
+        {
+            "properties": {"name": "Split"},
+            "geometry": {
+                "type": "MultiPolygon",
+                "coordinates": [[square(20, 20, 30, 30)], [square(40, 40, 50, 50)]],
+            },
+        },
+    ],
+}
+
+# A blank row makes read_csv parse the zip column as float
+CENTROIDS_CSV = "zip,lat,lon\n01234,2,2\n,,\n20601,45,45\n99999,100,100\n"
+
+
+@pytest.fixture
+def index():
+    county_index = CountyIndex(GEOJSON)
+    county_index.load_zip_centroids(pd.read_csv(io.StringIO(CENTROIDS_CSV)))
+    return county_index
+
+
+def test_strtree_matches_brute_force():
+    rng = random.Random(0)
+    boxes = []
+    for _ in range(300):
+        x, y = rng.uniform(0, 100), rng.uniform(0, 100)
+        boxes.append((x, y, x + rng.uniform(0, 10), y + rng.uniform(0, 10)))
+    tree = STRtree(boxes)
+
+    for _ in range(1000):
+        x, y = rng.uniform(-5, 115), rng.uniform(-5, 115)
+        expected = [
+            i
+            for i, (minx, miny, maxx, maxy) in enumerate(boxes)
+            if minx <= x <= maxx and miny <= y <= maxy
+        ]
+        assert sorted(tree.query(x, y)) == expected
+
+
+def test_strtree_empty():
+    assert STRtree([]).query(0, 0) == []
+
+
+@pytest.mark.parametrize(
+    "lat, lon, county",
+    [
+        (2, 2, "Holed"),
+        (4.2, 4.2, None),  # in the hole
+        (5, 5, "Island"),  # in the hole, inside another county
+        (25, 25, "Split"),
+        (45, 45, "Split"),  # second part of the MultiPolygon
+        (35, 35, None),  # between the parts, inside neither
+        (100, 100, None),
+    ],
+)
+def test_lookup(index, lat, lon, county):
+    assert index.lookup(lat, lon) == county
+
+
+def test_zip_centroids_with_blank_rows(index):
+    assert index.zip_counties == {"01234": "Holed", "20601": "Split"}
+
+
+@pytest.mark.parametrize(
+    "query, county",
+    [
+        ("2, 2", "Holed"),
+        (" 45,45 ", "Split"),
+        ("4.2, 4.2", None),
+        ("01234", "Holed"),
+        ("1234", "Holed"),  # zero padded
+        (" 20601 ", "Split"),
+        ("99999", None),  # centroid outside every county
+        ("", None),
+        (None, None),
+        ("abc", None),
+        ("1, 2, 3", None),
+        ("lat, lon", None),
+        ("20601-1234", None),
+    ],
+)
+def test_find(index, query, county):
+    assert index.find(query) == county
+
+
+def test_lookup_zip(index):
+    assert index.lookup_zip("01234") == "Holed"
+    assert index.lookup_zip(1234) == "Holed"
+    assert index.lookup_zip("00000") is None
+
+
+@pytest.mark.parametrize(
+    "query, status, county",
+    [
+        ("lat=2&lon=2", 200, "Holed"),
+        ("zip=01234", 200, "Holed"),
+        ("lat=100&lon=100", 404, None),
+        ("zip=00000", 404, None),
+        ("lat=2", 400, None),
+        ("lat=x&lon=2", 400, None),
+        ("", 400, None),
+    ],
+)
+def test_county_api(index, query, status, county):
+    server = Flask(__name__)
+    server.register_blueprint(county_api(index))
+
+    response = server.test_client().get(f"/api/county?{query}")
+    assert response.status_code == status
+    assert response.get_json().get("county") == county
@@ -0,0 +1,88 @@
+import time
+import threading
+
+import pytest
+
+import data_utils
+from data_utils import LoadS3, fetch_many, get_s3_client
+from conftest import BUCKET
+
+LATENCY = 0.2
+KEYS = {
+    "maryland-counties.geojson": b'{"type": "FeatureCollection", "features": []}',
+    "Population_Estimates_by_County.csv": b"County,Population\nAllegany,70000\n",
+    "vaccines_clean.csv": b"county,firstdosecumulative\nAllegany,1\n",
+}
+
+
+@pytest.fixture
+def s3(s3_resource):
+    """moto S3 with a fixed latency per get_object, counting requests per key"""
+    for key, body in KEYS.items():
+        s3_resource.Object(BUCKET, key).put(Body=body)
+
+    requests = []
+
+    def slow_get_object(params, **kwargs):
+        requests.append(params["Key"])
+        time.sleep(LATENCY)
+
+    get_s3_client().meta.events.register(
+        "before-parameter-build.s3.GetObject", slow_get_object
+    )
+    return requests
+
+
+def test_one_client_per_process(s3):
+    assert LoadS3("a").s3_client is LoadS3("b").s3_client is get_s3_client()
+
+
+def test_client_is_replaced_after_fork(s3, monkeypatch):
+    parent = get_s3_client()
+    monkeypatch.setattr(data_utils.os, "getpid", lambda: -1)
+    child = get_s3_client()
+    assert child is not parent
+    assert get_s3_client() is child
+
+
+def test_loads3_is_lazy(s3):
+    loader = LoadS3("vaccines_clean.csv")
+    assert s3 == []
+    loader.read_s3_df()
+    assert s3 == ["vaccines_clean.csv"]
+
+
+def test_fetch_many_one_request_per_key(s3):
+    csv_keys = [key for key in KEYS if key.endswith(".csv")]
+    data = fetch_many({key: LoadS3.read_s3_df for key in csv_keys})
+    data.update(fetch_many({"maryland-counties.geojson": LoadS3.read_s3_geojson}))
+
+    assert sorted(s3) == sorted(KEYS)
+    assert list(data["Population_Estimates_by_County.csv"]["Population"]) == [70000]
+    assert data["maryland-counties.geojson"]["features"] == []
+
+
+def test_fetch_many_reads_bodies_in_workers(s3):
+    threads = []
+
+    def reader(loader):
+        threads.append(threading.current_thread())
+        return loader.obj["Body"].read()
+
+    fetch_many({key: reader for key in KEYS})
+    assert threading.main_thread() not in threads
+
+
+def test_fetch_many_is_faster_than_sequential(s3):
+    start = time.perf_counter()
+    for key in KEYS:
+        LoadS3(key).obj["Body"].read()
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fetch_many({key: lambda loader: loader.obj["Body"].read() for key in KEYS})
+    concurrent = time.perf_counter() - start
+
+    assert sequential >= LATENCY * len(KEYS)
+    assert concurrent < LATENCY * 2
+    assert len(s3) == 2 * len(KEYS)
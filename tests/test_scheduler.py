@@ -0,0 +1,125 @@
+import pytest
+
+import helpers
+import main
+from helpers import WriteData, ETAG_META_KEY
+from conftest import BUCKET
+
+CSV = b"VACCINATION_DATE,County,FirstDoseCumulative\n2021/01/01,Allegany ,1\n"
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", etag=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"ETag": etag} if etag else {}
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSource:
+    """Stands in for requests.get, honouring If-None-Match"""
+
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(headers or {})
+        if (headers or {}).get("If-None-Match") == self.etag:
+            return FakeResponse(304)
+        return FakeResponse(200, self.content, self.etag)
+
+
+@pytest.fixture
+def source(monkeypatch):
+    fake = FakeSource(CSV, '"v1"')
+    monkeypatch.setattr(helpers.requests, "get", fake.get)
+    return fake
+
+
+def raw_metadata(s3_resource):
+    return s3_resource.Object(BUCKET, "data_raw.csv").metadata
+
+
+def test_failed_clean_upload_does_not_save_validators(
+    s3_resource, source, monkeypatch
+):
+    upload = WriteData.upload_df_to_s3_as_csv
+
+    def failing_clean(self, df, bucket_name, key):
+        if key.endswith("_clean.csv"):
+            return False
+        return upload(self, df, bucket_name, key)
+
+    monkeypatch.setattr(WriteData, "upload_df_to_s3_as_csv", failing_clean)
+    wd = WriteData(s3_resource=s3_resource)
+    assert wd.update_s3_df("url", BUCKET, "data") is False
+    assert ETAG_META_KEY not in raw_metadata(s3_resource)
+
+    # The next run must fetch in full and publish the clean file
+    monkeypatch.setattr(WriteData, "upload_df_to_s3_as_csv", upload)
+    assert WriteData(s3_resource=s3_resource).update_s3_df("url", BUCKET, "data")
+    assert "If-None-Match" not in source.requests[-1]
+    assert s3_resource.Object(BUCKET, "data_clean.csv").content_length > 0
+    assert raw_metadata(s3_resource)[ETAG_META_KEY] == '"v1"'
+
+
+def test_unchanged_source_is_a_no_op(s3_resource, source):
+    WriteData(s3_resource=s3_resource).update_s3_df("url", BUCKET, "data")
+
+    wd = WriteData(s3_resource=s3_resource)
+    assert wd.update_s3_df("url", BUCKET, "data")
+    assert wd.metrics["source_not_modified"]
+    assert wd.metrics["bytes_fetched"] == 0
+    assert wd.metrics["s3_puts"] == 0
+
+
+def test_new_etag_with_same_content_updates_metadata_only(s3_resource, source):
+    WriteData(s3_resource=s3_resource).update_s3_df("url", BUCKET, "data")
+    source.etag = '"v2"'
+
+    wd = WriteData(s3_resource=s3_resource)
+    assert wd.update_s3_df("url", BUCKET, "data")
+    assert wd.metrics["s3_puts"] == 0
+    assert raw_metadata(s3_resource)[ETAG_META_KEY] == '"v2"'
+
+    # So the run after that is a 304 again
+    wd = WriteData(s3_resource=s3_resource)
+    wd.update_s3_df("url", BUCKET, "data")
+    assert wd.metrics["source_not_modified"]
+
+
+def test_lock_blocks_other_runs_until_released(s3_resource):
+    client = s3_resource.meta.client
+    lease = main.acquire_lock(client, BUCKET)
+    assert lease is not None
+
+    # e.g. a one-off dyno started while the daemon is updating
+    assert main.acquire_lock(client, BUCKET) is None
+
+    main.release_lock(client, lease, BUCKET)
+    assert main.acquire_lock(client, BUCKET) is not None
+
+
+def test_expired_lock_is_taken_over(s3_resource):
+    client = s3_resource.meta.client
+    abandoned = main.acquire_lock(client, BUCKET, ttl=-1)
+    lease = main.acquire_lock(client, BUCKET)
+    assert lease is not None and lease != abandoned
+
+    # The abandoned run must not release the lease it lost
+    main.release_lock(client, abandoned, BUCKET)
+    assert main.acquire_lock(client, BUCKET) is None
+
+
+def test_run_once_skips_while_locked(s3_resource, monkeypatch):
+    client = s3_resource.meta.client
+    main.acquire_lock(client, BUCKET)
+    monkeypatch.setattr(main, "AWS_S3_BUCKET", BUCKET)
+    monkeypatch.setattr(
+        WriteData, "update_s3_df", lambda *a, **k: pytest.fail("ran while locked")
+    )
+    assert main.run_once()
@@ -0,0 +1,194 @@
+import json
+import random
+
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+
+import helpers
+from data_utils import LoadS3, apply_delta
+from helpers import WriteData, diff_lines
+from conftest import BUCKET
+
+
+def versions_df(n_rows: int, seed: int) -> pd.DataFrame:
+    rng = random.Random(seed)
+    return pd.DataFrame(
+        {
+            "County": [f"County {i % 24}" for i in range(n_rows)],
+            "First Dose": [rng.randint(0, 1000) for _ in range(n_rows)],
+        }
+    )
+
+
+def test_delta_round_trip():
+    # Random edits of short files with many repeated rows
+    for seed in range(200):
+        rng = random.Random(seed)
+        base = [str(rng.randint(0, 8)) for _ in range(rng.randint(0, 30))]
+        new = list(base)
+        for _ in range(rng.randint(0, 8)):
+            op = rng.random()
+            if op < 0.3 and new:
+                new.pop(rng.randrange(len(new)))
+            elif op < 0.6:
+                new.insert(rng.randint(0, len(new)), str(rng.randint(0, 12)))
+            elif op < 0.8 and new:
+                new[rng.randrange(len(new))] = "changed"
+            elif new:
+                new.insert(rng.randint(0, len(new)), new.pop())
+
+        assert apply_delta(base, diff_lines(base, new)) == new, f"seed {seed}"
+
+
+def test_moved_row_is_a_small_delta():
+    base = [f"row {i}" for i in range(12000)]
+    new = [base[-1]] + base[:-1]
+
+    delta = diff_lines(base, new)
+    assert len(delta["added"]) == 1
+    assert delta["removed"] == [[11999, 12000]]
+    assert apply_delta(base, delta) == new
+
+
+def test_snapshots_rebuild_every_version(s3_resource):
+    wd = WriteData(s3_resource=s3_resource)
+    published = []
+    df = versions_df(500, 0)
+    for i in range(5):
+        df = df.copy()
+        df.loc[i * 7, "First Dose"] += 1  # a few changed rows per version
+        df = pd.concat([df, versions_df(3, i)], ignore_index=True)
+        assert wd.publish_snapshot(df, BUCKET, "data_clean") == i
+        published.append(df)
+
+    # Unchanged data does not make a new version
+    assert wd.publish_snapshot(df, BUCKET, "data_clean") is None
+
+    manifest = LoadS3("data_clean_snapshots/manifest.json")
+    types = [v["type"] for v in json.load(manifest.obj["Body"])["versions"]]
+    assert types == ["checkpoint"] + ["delta"] * 4
+
+    for version, expected in enumerate(published):
+        rebuilt = LoadS3("data_clean_snapshots/manifest.json").read_snapshot(version)
+        pd.testing.assert_frame_equal(rebuilt, expected)
+
+
+def test_large_delta_is_stored_as_checkpoint(s3_resource):
+    wd = WriteData(s3_resource=s3_resource)
+    wd.publish_snapshot(versions_df(500, 0), BUCKET, "data_clean")
+    wd.publish_snapshot(versions_df(500, 1), BUCKET, "data_clean")  # every row
+
+    loader = LoadS3("data_clean_snapshots/manifest.json")
+    rebuilt = loader.read_snapshot(1)
+    pd.testing.assert_frame_equal(rebuilt, versions_df(500, 1))
+    assert not any(
+        key.key.endswith(".delta.json.gz")
+        for key in s3_resource.Bucket(BUCKET).objects.all()
+    )
+
+
+@pytest.mark.parametrize("version", [-1, 2])
+def test_read_snapshot_rejects_unknown_versions(s3_resource, version):
+    wd = WriteData(s3_resource=s3_resource)
+    wd.publish_snapshot(versions_df(10, 0), BUCKET, "data_clean")
+    wd.publish_snapshot(versions_df(10, 1), BUCKET, "data_clean")
+
+    with pytest.raises(ValueError):
+        LoadS3("data_clean_snapshots/manifest.json").read_snapshot(version)
+
+
+def test_unreadable_manifest_does_not_reset_history(s3_resource, monkeypatch):
+    wd = WriteData(s3_resource=s3_resource)
+    wd.publish_snapshot(versions_df(10, 0), BUCKET, "data_clean")
+    manifest_key = "data_clean_snapshots/manifest.json"
+    before = s3_resource.Object(BUCKET, manifest_key).get()["Body"].read()
+
+    original_object = s3_resource.Object
+
+    class DeniedObject:
+        def __init__(self, bucket_name, key):
+            self.obj = original_object(bucket_name, key)
+
+        def get(self):
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+
+        def put(self, **kwargs):
+            return self.obj.put(**kwargs)
+
+    monkeypatch.setattr(s3_resource, "Object", DeniedObject)
+    with pytest.raises(ClientError):
+        wd.publish_snapshot(versions_df(10, 1), BUCKET, "data_clean")
+
+    monkeypatch.undo()
+    after = s3_resource.Object(BUCKET, manifest_key).get()["Body"].read()
+    assert after == before
+
+
+def test_failed_upload_is_not_snapshotted(s3_resource, monkeypatch):
+    csv = b"VACCINATION_DATE,County,FirstDoseCumulative\n2021/01/01,Allegany ,1\n"
+
+    class Response:
+        status_code = 200
+        content = csv
+        headers = {}
+
+        def raise_for_status(self):
+            pass
+
+    monkeypatch.setattr(helpers.requests, "get", lambda *a, **k: Response())
+    upload = WriteData.upload_df_to_s3_as_csv
+    monkeypatch.setattr(
+        WriteData,
+        "upload_df_to_s3_as_csv",
+        lambda self, df, bucket, key: False
+        if key.endswith("_clean.csv")
+        else upload(self, df, bucket, key),
+    )
+
+    assert not WriteData(s3_resource=s3_resource).update_s3_df("url", BUCKET, "data")
+    keys = {obj.key for obj in s3_resource.Bucket(BUCKET).objects.all()}
+    assert "data_raw_snapshots/manifest.json" in keys
+    assert not any(key.startswith("data_clean_snapshots/") for key in keys)
+
+
+def test_interrupted_publish_does_not_corrupt_the_next_delta(s3_resource, monkeypatch):
+    wd = WriteData(s3_resource=s3_resource)
+    v0, v1 = versions_df(500, 0), versions_df(500, 0)
+    v1.loc[3, "First Dose"] += 1
+    wd.publish_snapshot(v0, BUCKET, "data_clean")
+
+    # Head is written, then the run dies before the manifest put
+    put = WriteData.put_s3_bytes
+
+    def failing_manifest(self, bucket_name, key, *args, **kwargs):
+        if key.endswith("manifest.json"):
+            raise ClientError({"Error": {"Code": "InternalError"}}, "PutObject")
+        return put(self, bucket_name, key, *args, **kwargs)
+
+    monkeypatch.setattr(WriteData, "put_s3_bytes", failing_manifest)
+    with pytest.raises(ClientError):
+        wd.publish_snapshot(v1, BUCKET, "data_clean")
+    monkeypatch.undo()
+
+    assert wd.publish_snapshot(v1, BUCKET, "data_clean") == 1
+    loader = LoadS3("data_clean_snapshots/manifest.json")
+    pd.testing.assert_frame_equal(loader.read_snapshot(1), v1)
+
+
+def test_read_snapshot_rejects_corrupted_versions(s3_resource):
+    wd = WriteData(s3_resource=s3_resource)
+    v0, v1 = versions_df(500, 0), versions_df(500, 0)
+    v1.loc[3, "First Dose"] += 1
+    wd.publish_snapshot(v0, BUCKET, "data_clean")
+    wd.publish_snapshot(v1, BUCKET, "data_clean")
+
+    # Point version 1 at an object holding other content
+    manifest_key = "data_clean_snapshots/manifest.json"
+    manifest = json.loads(s3_resource.Object(BUCKET, manifest_key).get()["Body"].read())
+    manifest["versions"][1]["key"] = manifest["versions"][0]["key"]
+    manifest["versions"][1]["type"] = "checkpoint"
+    s3_resource.Object(BUCKET, manifest_key).put(Body=json.dumps(manifest))
+
+    with pytest.raises(ValueError):
+        LoadS3(manifest_key).read_snapshot(1)